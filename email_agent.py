@@ -1,31 +1,51 @@
+import asyncio
 import os
-from typing import Dict
+from typing import Dict, Optional
 
 # SendGrid (for optional email delivery)
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Email, To, Content
 from agents import Agent, function_tool
 
-@function_tool
-def send_email_to(to_email: str, subject: str, html_body: str) -> Dict[str, str]:
+# Built lazily on first send (not at import: the entrypoint loads .env after
+# importing this module, so SENDGRID_API_KEY may not be in os.environ yet)
+# and then reused, so repeated sends skip client setup and TLS handshakes.
+_SG: Optional[SendGridAPIClient] = None
+_FROM = Email("smohadde@uci.edu")  # <-- must be verified in SendGrid
+
+
+def _get_client() -> Optional[SendGridAPIClient]:
+    global _SG
+    if _SG is None and os.environ.get("SENDGRID_API_KEY"):
+        _SG = SendGridAPIClient(api_key=os.environ["SENDGRID_API_KEY"])
+    return _SG
+
+
+async def send_email_impl(to_email: str, subject: str, html_body: str) -> Dict[str, str]:
     """
     Send an email (HTML) to a recipient via SendGrid.
-    Expects SENDGRID_API_KEY in environment and a verified sender (from_email).
+    Expects SENDGRID_API_KEY in environment and a verified sender (_FROM).
+    The blocking SendGrid HTTP call runs in a worker thread so the event
+    loop (status streaming, concurrent searches) keeps making progress.
     """
-    sg_key = os.environ.get("SENDGRID_API_KEY")
-    if not sg_key:
+    sg = _get_client()
+    if sg is None:
         return {"status": "skipped", "reason": "SENDGRID_API_KEY not set"}
     try:
-        sg = SendGridAPIClient(api_key=sg_key)
-        from_email = Email("smohadde@uci.edu")  # <-- must be verified in SendGrid
         to = To((to_email or "").strip())
         content = Content("text/html", html_body)
-        mail = Mail(from_email, to, subject, content).get()
-        sg.client.mail.send.post(request_body=mail)
+        mail = Mail(_FROM, to, subject, content).get()
+        await asyncio.to_thread(sg.client.mail.send.post, request_body=mail)
         return {"status": "sent"}
     except Exception as e:
         return {"status": "error", "reason": str(e)}
 
+
+@function_tool
+async def send_email_to(to_email: str, subject: str, html_body: str) -> Dict[str, str]:
+    """Send an email (HTML) to a recipient via SendGrid."""
+    return await send_email_impl(to_email, subject, html_body)
+
 INSTRUCTIONS = """You are able to send a nicely formatted HTML email based on a detailed report.
 You will be provided with a detailed report. You should use your tool to send one email, providing the 
 report converted into clean, well presented HTML with an appropriate subject line."""
@@ -1,45 +1,83 @@
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
+import difflib
+import io
 import itertools
+import multiprocessing
+import os
+import sys
 from typing import List, Optional, Dict, Any
 
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 import gradio as gr
+import httpx
 import re
+from openai import AsyncOpenAI
 from agents import (
     Agent,
     Runner,
     trace,
-    function_tool,
     gen_trace_id,
-    input_guardrail,
-    output_guardrail,
-    GuardrailFunctionOutput,
+    set_default_openai_client,
 )
-from agents.model_settings import ModelSettings
 from search_agent import search_agent, SearchSummary
-from planner_agent import planner_agent
-from writer_agent import writer_agent
-from email_agent import email_agent
-import html
-from agents.exceptions import (
-    InputGuardrailTripwireTriggered,
-    OutputGuardrailTripwireTriggered,
-)
+from planner_agent import planner_agent, WebSearchPlan, HOW_MANY_SEARCHES
+from writer_agent import writer_agent, ReportData
+from email_agent import send_email_impl
 
 # --------------------------------------------------------------------------------------
 # Env
 # --------------------------------------------------------------------------------------
 load_dotenv(override=True)
 
+# --------------------------------------------------------------------------------------
+# Shared HTTP client (connection pooling / keep-alive for all LLM traffic)
+# --------------------------------------------------------------------------------------
+# One pooled client for every Runner.run call in the process; without it each
+# agent turn can pay a fresh TCP+TLS handshake (~100-300 ms), which adds up
+# over the 10+ API calls a pipeline run makes.
+HTTP = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_keepalive_connections=32,
+        max_connections=100,
+        keepalive_expiry=30.0,
+    ),
+    timeout=60.0,
+)
+if os.environ.get("OPENAI_API_KEY"):
+    set_default_openai_client(AsyncOpenAI(http_client=HTTP))
+
+_PREWARMED = False
+
+
+async def _prewarm_connections():
+    """
+    Open a keep-alive connection to the OpenAI host before the first query,
+    so the first LLM call skips the TCP+TLS handshake. Only the shared pool
+    is warmed: the email path uses SendGrid's own client, which this pool
+    can't warm. Wired to the Gradio load event because the event loop
+    doesn't exist at import time.
+    """
+    global _PREWARMED
+    if _PREWARMED:
+        return
+    _PREWARMED = True
+    try:
+        await HTTP.head("https://api.openai.com/v1/models")
+    except Exception:
+        pass  # best-effort; the real call just pays the handshake instead
+
 # --------------------------------------------------------------------------------------
 # Live status bus (for streaming status to the UI)
 # --------------------------------------------------------------------------------------
 class StatusBus:
-    def __init__(self):
-        self._q: asyncio.Queue[str] = asyncio.Queue()
+    def __init__(self, maxsize: int = 256):
+        # Bounded so a stalled consumer applies backpressure to publishers
+        # instead of growing the queue without limit.
+        self._q: asyncio.Queue[str] = asyncio.Queue(maxsize=maxsize)
 
     async def publish(self, msg: str):
         await self._q.put(msg)
@@ -50,18 +88,165 @@ class StatusBus:
         except asyncio.TimeoutError:
             return None
 
+    async def get_wait(self) -> str:
+        """Block until the next message arrives (no polling timeout)."""
+        return await self._q.get()
+
+    def drain_nowait(self) -> List[str]:
+        """Pop every message currently queued without blocking."""
+        msgs: List[str] = []
+        while True:
+            try:
+                msgs.append(self._q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return msgs
+
 STATUS_BUS = StatusBus()
 
+# Partial-report frames (full HTML snapshots) streamed to the UI while the
+# writer is still generating; the drain loop shows the latest snapshot.
+REPORT_BUS = StatusBus()
+
+
+def _enable_eager_tasks() -> None:
+    """
+    Install asyncio's eager task factory (Python 3.12+) on the running loop.
+    Short coroutines (status publishes, cache hits) then execute up to their
+    first blocking await without a trip through the ready queue. Called from
+    the async entry points because Gradio owns the event loop, which does not
+    exist yet at import time.
+    """
+    if sys.version_info >= (3, 12):
+        loop = asyncio.get_running_loop()
+        if loop.get_task_factory() is not asyncio.eager_task_factory:
+            loop.set_task_factory(asyncio.eager_task_factory)
+
+# --------------------------------------------------------------------------------------
+# Content-addressed caches for repeated LLM calls
+# --------------------------------------------------------------------------------------
+# Keyed on the normalized input text; identical queries skip the LLM round-trip
+# entirely. A per-key Event coalesces concurrent identical calls so a query that
+# is already in flight is awaited rather than re-issued (stampede protection).
+_CLARIFY_CACHE: Dict[str, ClarificationQuestions] = {}
+_PLAN_CACHE: Dict[str, WebSearchPlan] = {}
+_SEARCH_CACHE: Dict[str, SearchSummary] = {}
+_PREP_CACHE: Dict[str, ClarifyAndPlan] = {}
+_CACHE_EVENTS: Dict[tuple[str, str], asyncio.Event] = {}
+
+
+# Cap on concurrent LLM calls: beyond this, connection churn and scheduler
+# overhead start to cost more than the extra parallelism buys.
+_LLM_SEM = asyncio.Semaphore(8)
+
+
+async def run_llm(agent, inp, **kwargs):
+    """Runner.run gated by the module-wide concurrency cap."""
+    async with _LLM_SEM:
+        return await Runner.run(agent, inp, **kwargs)
+
+
+def _cache_key(text: str) -> str:
+    return text.strip().lower()
+
+
+async def _run_cached(cache: Dict[str, Any], role: str, key: str, run):
+    """Return cache[key], running `run()` at most once per key across tasks."""
+    if key in cache:
+        return cache[key]
+    ev_key = (role, key)
+    pending = _CACHE_EVENTS.get(ev_key)
+    if pending is not None:
+        await pending.wait()
+        if key in cache:
+            return cache[key]
+    ev = asyncio.Event()
+    _CACHE_EVENTS[ev_key] = ev
+    try:
+        value = await run()
+        cache[key] = value
+        return value
+    finally:
+        ev.set()
+        _CACHE_EVENTS.pop(ev_key, None)
+
+
+async def run_clarifier(query: str) -> ClarificationQuestions:
+    """Clarifier call with caching; repeat queries reuse the stored questions."""
+
+    async def _run():
+        r = await run_llm(clarifier_agent, query)
+        return r.final_output_as(ClarificationQuestions)
+
+    return await _run_cached(_CLARIFY_CACHE, "clarify", _cache_key(query), _run)
+
 
-@function_tool
-async def search_once(query: str) -> Dict[str, Any]:
+async def run_planner(query: str) -> WebSearchPlan:
+    """Planner call with caching; repeat queries reuse the stored plan."""
+
+    async def _run():
+        r = await run_llm(planner_agent, query)
+        return r.final_output_as(WebSearchPlan)
+
+    return await _run_cached(_PLAN_CACHE, "plan", _cache_key(query), _run)
+
+
+_NORM_NONWORD = re.compile(r"\W+")
+
+
+def _dedupe_queries(queries: List[str]) -> List[str]:
     """
-    Run a single search via the search_agent and return {query, summary, sources}.
-    Sequential search; manager loops as needed.
+    Drop exact and near-duplicate search queries before fan-out. Queries are
+    compared on a normalized form (lowercased, punctuation collapsed); near-
+    dupes are caught with a SequenceMatcher ratio. Each duplicate skipped
+    saves a full LLM+web-search round-trip.
     """
-    r = await Runner.run(search_agent, query)
-    out = r.final_output_as(SearchSummary)
-    return {"query": query, "summary": out.summary, "sources": out.sources}
+    kept: List[str] = []
+    kept_norm: List[str] = []
+    for q in queries:
+        norm = _NORM_NONWORD.sub(" ", q.lower()).strip()
+        if not norm or norm in kept_norm:
+            continue
+        if any(difflib.SequenceMatcher(None, norm, k).ratio() > 0.85 for k in kept_norm):
+            continue
+        kept.append(q)
+        kept_norm.append(norm)
+    return kept
+
+
+async def run_search(query: str) -> SearchSummary:
+    """Single search via search_agent with caching by normalized query."""
+
+    async def _run():
+        r = await run_llm(search_agent, query)
+        return r.final_output_as(SearchSummary)
+
+    return await _run_cached(_SEARCH_CACHE, "search", _cache_key(query), _run)
+
+
+async def run_prep(query: str) -> ClarifyAndPlan:
+    """
+    Clarifying questions and the search plan in ONE LLM call (prep_agent).
+    Both halves are also written into the clarifier/planner caches, so the
+    pipeline's later run_planner is a cache hit rather than a round-trip.
+    """
+
+    async def _run():
+        r = await run_llm(prep_agent, query)
+        out = r.final_output_as(ClarifyAndPlan)
+        key = _cache_key(query)
+        _CLARIFY_CACHE[key] = out.questions
+        _PLAN_CACHE[key] = out.plan
+        return out
+
+    return await _run_cached(_PREP_CACHE, "prep", _cache_key(query), _run)
+
+
+async def yield_status(message: str) -> str:
+    """Stream a short status update to the UI (and echo to stdout)."""
+    print(message)
+    await STATUS_BUS.publish(message + "\n")
+    return message
 
 # --------------------------------------------------------------------------------------
 # Helper: extract raw user query for guardrails
@@ -95,38 +280,186 @@ clarifier_agent = Agent(
 )
 
 
-@function_tool
-def convert_to_html(markdown_text: str, doc_title: str | None = None) -> dict:
+# Clarifier + planner combined into one call: both run on the bare query, so
+# asking for them together halves the round-trips on the auto-generate path.
+class ClarifyAndPlan(BaseModel):
+    questions: ClarificationQuestions = Field(description="Three clarifying questions.")
+    plan: WebSearchPlan = Field(description="The web searches to perform.")
+
+PREP_INSTRUCTIONS = (
+    "You are a research prep assistant. Given a user query, produce in one pass: "
+    "(1) exactly three concrete clarifying questions that would materially improve "
+    "the research (scope, constraints, audience, timeframe, success criteria), and "
+    f"(2) exactly {HOW_MANY_SEARCHES} web search items that, together, best answer the query."
+)
+
+prep_agent = Agent(
+    name="PrepAgent",
+    instructions=PREP_INSTRUCTIONS,
+    model="gpt-4o-mini",
+    output_type=ClarifyAndPlan,
+)
+
+
+# One combined inline pattern (bold / italic / link) dispatched per match, so
+# inline formatting is resolved in a single scan of each line.
+_MD_INLINE = re.compile(
+    r"\*\*(?P<bold>.*?)\*\*"
+    r"|\*(?P<em>.*?)\*"
+    r"|\[(?P<text>.*?)\]\((?P<url>.*?)\)"
+)
+
+
+def _render_inline(m: re.Match) -> str:
+    if m.group("bold") is not None:
+        return f"<strong>{m.group('bold')}</strong>"
+    if m.group("em") is not None:
+        return f"<em>{m.group('em')}</em>"
+    return f"<a href='{m.group('url')}'>{m.group('text')}</a>"
+
+
+# Single-pass HTML escaping via str.translate (C-level; same output as
+# html.escape but one table lookup per character, no chained str.replace).
+_HTML_ESC = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"}
+)
+
+
+class _StreamingMarkdownConverter:
     """
-    Convert basic Markdown to simple HTML (no external dependencies).
-    Handles headings, bold, italics, links, lists, and paragraphs.
-    Returns: {"html": "<!doctype html>..."}
+    The line-scanning Markdown->HTML state machine, usable incrementally:
+    feed() accepts arbitrary chunks (complete lines are converted as soon as
+    they arrive), close() flushes the partial tail and open list state.
     """
-    title = html.escape(doc_title or "Report")
-    text = html.escape(markdown_text)
-
-    # --- very lightweight markdown replacements ---
-    text = re.sub(r"^###### (.*)$", r"<h6>\1</h6>", text, flags=re.MULTILINE)
-    text = re.sub(r"^##### (.*)$", r"<h5>\1</h5>", text, flags=re.MULTILINE)
-    text = re.sub(r"^#### (.*)$", r"<h4>\1</h4>", text, flags=re.MULTILINE)
-    text = re.sub(r"^### (.*)$", r"<h3>\1</h3>", text, flags=re.MULTILINE)
-    text = re.sub(r"^## (.*)$", r"<h2>\1</h2>", text, flags=re.MULTILINE)
-    text = re.sub(r"^# (.*)$", r"<h1>\1</h1>", text, flags=re.MULTILINE)
-
-    text = re.sub(r"\*\*(.*?)\*\*", r"<strong>\1</strong>", text)
-    text = re.sub(r"\*(.*?)\*", r"<em>\1</em>", text)
-    text = re.sub(r"\[(.*?)\]\((.*?)\)", r"<a href='\2'>\1</a>", text)
-    text = re.sub(r"^- (.*)$", r"<li>\1</li>", text, flags=re.MULTILINE)
-    text = re.sub(r"(<li>.*</li>)", r"<ul>\1</ul>", text, count=1)
-
-    # simple paragraph wrapping
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    html_body = "".join(
-        f"<p>{line}</p>" if not line.startswith("<h") and not line.startswith("<ul>") else line
-        for line in lines
-    )
 
-    html_doc = (
+    def __init__(self):
+        self._buf = io.StringIO()
+        self._tail = ""
+        self._in_list = False
+
+    def feed(self, chunk: str) -> None:
+        self._tail += chunk
+        *lines, self._tail = self._tail.split("\n")
+        for line in lines:
+            self._emit(line.translate(_HTML_ESC))
+
+    def close(self) -> str:
+        if self._tail:
+            self._emit(self._tail.translate(_HTML_ESC))
+            self._tail = ""
+        if self._in_list:
+            self._buf.write("</ul>")
+            self._in_list = False
+        return self._buf.getvalue()
+
+    def snapshot(self) -> str:
+        """Converted body so far, with any open list closed for valid HTML."""
+        body = self._buf.getvalue()
+        return f"{body}</ul>" if self._in_list else body
+
+    def _emit(self, line: str) -> None:
+        s = line.strip()
+        if not s:
+            return
+        if s.startswith("#"):
+            level = len(s) - len(s.lstrip("#"))
+            if level <= 6 and s[level : level + 1] == " ":
+                if self._in_list:
+                    self._buf.write("</ul>")
+                    self._in_list = False
+                body = _MD_INLINE.sub(_render_inline, s[level + 1 :].strip())
+                self._buf.write(f"<h{level}>{body}</h{level}>")
+                return
+        if s.startswith("- "):
+            if not self._in_list:
+                self._buf.write("<ul>")
+                self._in_list = True
+            self._buf.write(f"<li>{_MD_INLINE.sub(_render_inline, s[2:])}</li>")
+            return
+        if self._in_list:
+            self._buf.write("</ul>")
+            self._in_list = False
+        self._buf.write(f"<p>{_MD_INLINE.sub(_render_inline, s)}</p>")
+
+
+class _JsonStringFieldStream:
+    """
+    Incrementally extract one string field from streamed JSON. The writer
+    streams ReportData as raw JSON deltas; this pulls the markdown_report
+    value out as plain text (decoding escapes) while tokens are still
+    arriving, so conversion can overlap with generation.
+    """
+
+    def __init__(self, key: str):
+        self._key = f'"{key}"'
+        self._pre = ""
+        self._state = "seek"  # seek -> value -> done
+        self._esc = False
+        self._unicode: Optional[str] = None
+
+    @property
+    def found(self) -> bool:
+        return self._state != "seek"
+
+    def feed(self, chunk: str) -> str:
+        """Return the decoded piece of the field value contained in chunk."""
+        if self._state == "done":
+            return ""
+        if self._state == "seek":
+            self._pre += chunk
+            idx = self._pre.find(self._key)
+            if idx == -1:
+                # keep a tail in case the key is split across chunks
+                self._pre = self._pre[-(len(self._key) + 16):]
+                return ""
+            rest = self._pre[idx + len(self._key):]
+            j = 0
+            while j < len(rest) and rest[j] in ' \t\r\n:':
+                j += 1
+            if j >= len(rest) or rest[j] != '"':
+                self._pre = self._pre[idx:]  # opening quote not arrived yet
+                return ""
+            self._state = "value"
+            self._pre = ""
+            chunk = rest[j + 1:]
+
+        out: List[str] = []
+        for ch in chunk:
+            if self._unicode is not None:
+                self._unicode += ch
+                if len(self._unicode) == 4:
+                    try:
+                        out.append(chr(int(self._unicode, 16)))
+                    except ValueError:
+                        pass
+                    self._unicode = None
+                continue
+            if self._esc:
+                self._esc = False
+                if ch == "n":
+                    out.append("\n")
+                elif ch == "t":
+                    out.append("\t")
+                elif ch == "r":
+                    out.append("\r")
+                elif ch == "u":
+                    self._unicode = ""
+                else:
+                    out.append(ch)
+                continue
+            if ch == "\\":
+                self._esc = True
+                continue
+            if ch == '"':
+                self._state = "done"
+                break
+            out.append(ch)
+        return "".join(out)
+
+
+def _wrap_html(html_body: str, doc_title: str | None = None) -> str:
+    title = (doc_title or "Report").translate(_HTML_ESC)
+    return (
         "<!doctype html>"
         "<html><head><meta charset='utf-8'>"
         f"<title>{title}</title>"
@@ -134,35 +467,51 @@ def convert_to_html(markdown_text: str, doc_title: str | None = None) -> dict:
         f"{html_body}"
         "</body></html>"
     )
-    return {"html": html_doc}
 
-# --------------------------------------------------------------------------------------
-# Tools for the Manager (LLM-callable)
-# --------------------------------------------------------------------------------------
-@function_tool
-async def yield_status(message: str) -> str:
-    """Stream a short status update to the caller/UI."""
-    print(message)
-    await STATUS_BUS.publish(message + "\n")
-    return message
 
-# Expose agents as tools the manager can call
-clarify_tool = clarifier_agent.as_tool(
-    tool_name="clarify_with_llm",
-    tool_description="Ask exactly three clarifying questions for the query."
-)
-plan_tool = planner_agent.as_tool(
-    tool_name="plan_with_llm",
-    tool_description="Propose exactly N web search items for the query."
-)
-write_tool = writer_agent.as_tool(
-    tool_name="write_with_llm",
-    tool_description="Generate a detailed markdown report from notes and the original query."
-)
-email_tool = email_agent.as_tool(
-    tool_name="email_with_llm",
-    tool_description="send a detailed HTML email with an appropriate subject line."
-)
+def convert_to_html_impl(markdown_text: str, doc_title: str | None = None) -> dict:
+    """
+    Convert basic Markdown to simple HTML (no external dependencies).
+    Handles headings, bold, italics, links, lists, and paragraphs in a single
+    line-by-line pass (instead of stacked whole-document regex rewrites).
+    Plain function so the pipeline can call it in-process (no tool round-trip).
+    Returns: {"html": "<!doctype html>..."}
+    """
+    conv = _StreamingMarkdownConverter()
+    conv.feed(markdown_text)
+    return {"html": _wrap_html(conv.close(), doc_title)}
+
+
+# Small process pool for full-document conversions, so multi-page regex work
+# doesn't hold the GIL on the event loop thread while statuses stream. Fork
+# context only: a spawn worker would re-import this module and build a second
+# Gradio app, since the UI is constructed at import time.
+try:
+    _CPU_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = (
+        concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context("fork")
+        )
+    )
+    # Fork the workers NOW, while the process is still single-threaded.
+    # ProcessPoolExecutor forks lazily on first submit, which would otherwise
+    # happen mid-request — after Gradio/uvicorn have started server threads,
+    # where forking risks deadlock and inherits the listening socket.
+    for _warmup in [_CPU_POOL.submit(os.getpid) for _ in range(2)]:
+        _warmup.result()
+    del _warmup
+except ValueError:  # platform without fork
+    _CPU_POOL = None
+
+
+async def convert_to_html_async(markdown_text: str, doc_title: str | None = None) -> dict:
+    """convert_to_html_impl off the event loop (process pool when available)."""
+    if _CPU_POOL is None:
+        return convert_to_html_impl(markdown_text, doc_title)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _CPU_POOL, convert_to_html_impl, markdown_text, doc_title
+    )
+
 
 # --------------------------------------------------------------------------------------
 # Guardrails
@@ -195,91 +544,120 @@ Rules:
 Keep 'brief' concise; no extra text beyond the JSON.
 """
 
+# The guardrail agents are invoked explicitly by run_pipeline (input gate) —
+# the pipeline structure is fixed Python, so no decorated tripwire plumbing.
 guardrail_input_agent  = Agent(name="GuardrailInput",  instructions=INPUT_GUARDRAIL_INSTRUCTIONS,  model="gpt-4o-mini", output_type=SimpleGuardrailOutput)
 guardrail_output_agent = Agent(name="GuardrailOutput", instructions=OUTPUT_GUARDRAIL_INSTRUCTIONS, model="gpt-4o-mini", output_type=SimpleGuardrailOutput)
 
-@input_guardrail
-async def guardrail_input(ctx, agent, message):
-    query_only = _extract_query_only(message)
-    res = await Runner.run(guardrail_input_agent, query_only, context=ctx.context)
-    g = res.final_output_as(SimpleGuardrailOutput)
+# --------------------------------------------------------------------------------------
+# Deterministic pipeline (in-process orchestration; the pipeline shape is fixed,
+# so no LLM is consulted to sequence the steps)
+# --------------------------------------------------------------------------------------
+HARD_INPUT_FLAGS = {"unsafe", "illegal", "pii", "adult", "private_data"}
 
-    hard_flags = {"unsafe", "illegal", "pii", "adult", "private_data"}
-    trip = any(f in hard_flags for f in (g.flags or []))
 
-    return GuardrailFunctionOutput(
-        output_info={
-            "flags": g.flags,
-            "brief": g.brief or "No reason provided by the guardrail agent.",
-        },
-        tripwire_triggered=trip,
-    )
+class GuardrailBlocked(Exception):
+    """Raised when the explicit input guardrail blocks a query."""
 
-@output_guardrail
-async def guardrail_output(ctx, agent, message):
-    res = await Runner.run(guardrail_output_agent, message, context=ctx.context)
-    g = res.final_output_as(SimpleGuardrailOutput)
+    def __init__(self, flags: List[str], brief: Optional[str]):
+        self.flags = flags or []
+        self.brief = brief or "The request did not meet safety or clarity requirements."
+        super().__init__(self.brief)
 
-    hard_flags = {"unsafe", "illegal", "pii", "adult", "private_data", "speculative"}
-    trip = any(f in hard_flags for f in (g.flags or []))
 
-    return GuardrailFunctionOutput(
-        output_info={
-            "flags": g.flags,
-            "brief": g.brief or "No reason provided by the guardrail agent.",
-        },
-        tripwire_triggered=trip,
-    )
+async def run_pipeline(query: str, clar_text: str, email: str) -> str:
+    """
+    Orchestrate clarify -> plan -> search -> write -> convert -> email directly
+    in Python. Each step is one Runner.run call (searches fan out concurrently),
+    so no LLM turns are spent re-deriving which tool to call next.
+    Returns the final report as an HTML string.
+    """
+    # Explicit input guardrail, run before any paid work.
+    res = await run_llm(guardrail_input_agent, _extract_query_only(query))
+    g = res.final_output_as(SimpleGuardrailOutput)
+    if any(f in HARD_INPUT_FLAGS for f in (g.flags or [])):
+        raise GuardrailBlocked(g.flags, g.brief)
+
+    # 1) Clarify: only when the user provided nothing; surface questions as status.
+    if "(skipped by user)" in clar_text or "(none provided)" in clar_text:
+        clar = await run_clarifier(query)
+        await yield_status(
+            "Clarifying questions (proceeding without answers):\n"
+            f"1) {clar.q1}\n2) {clar.q2}\n3) {clar.q3}"
+        )
 
-# --------------------------------------------------------------------------------------
-# Manager Agent (agentic orchestration with tools)
-# --------------------------------------------------------------------------------------
-MANAGER_INSTRUCTIONS = """
-You are the Research Manager. Coordinate the research pipeline by calling tools only (no free text except via yield_status).
-
-Inputs you receive:
-- QUERY: <text>
-- USER_CLARIFICATIONS: <block or "(skipped by user)" or "(none provided)">
-- RECIPIENT_EMAIL: <an email or "(none)">
-
-Workflow:
-1) Clarify: 
-   • If USER_CLARIFICATIONS are "(skipped by user)" or "(none provided)", call clarify_with_llm to produce exactly 3 clarifying questions, and show them via yield_status. 
-   • Otherwise, skip clarification.
-2) Plan: call plan_with_llm(query=QUERY). Then yield_status("Planning complete").
-3) Search: for each search item, call search_once(query=...). After each, yield_status("Search i/N complete").
-4) Aggregate: combine all search summaries into RESEARCH_NOTES (plain text).
-5) Write: call write_with_llm(original_query=QUERY, clarifications=USER_CLARIFICATIONS, notes=RESEARCH_NOTES) for a 1000+ word Markdown report with sections:
-   Executive Summary, Key Findings (with [#] citations), Assumptions & Limitations, Open Questions, and Next Steps.
-6) Convert: call convert_to_html(markdown_text=<the report>, doc_title="Research Report").
-7) Email (optional): 
-   • If RECIPIENT_EMAIL != "(none)", call send_email_to(to_email=RECIPIENT_EMAIL,
-     subject=f"Research Report: {QUERY[:80]}", html_body=<converted HTML>).
-   • Yield_status("Email sent") after success or "Email failed" if the tool errors.
-
-Constraints:
-- Use yield_status between steps to narrate progress.
-- Never fabricate outputs; rely on actual tool results.
-- Return ONLY the final HTML string from step 6 as your assistant output (not markdown or other text).
-"""
+    # 2) Plan
+    plan = await run_planner(query)
+    await yield_status("Planning complete")
 
-manager_agent = Agent(
-    name="Research Manager",
-    instructions=MANAGER_INSTRUCTIONS,
-    tools=[
-        yield_status,
-        clarify_tool,
-        plan_tool,
-        search_once,
-        write_tool,
-        convert_to_html,
-        email_tool,
-    ],
-    model="gpt-4o-mini",
-    model_settings=ModelSettings(tool_choice="required"),
-    input_guardrails=[guardrail_input],
-    # output_guardrails=[guardrail_output],  # enable if you want final QA gating
-)
+    # 3) Search (concurrent fan-out, near-duplicate queries dropped)
+    queries = _dedupe_queries([item.query for item in plan.searches])
+    if len(queries) < len(plan.searches):
+        await yield_status(
+            f"Skipped {len(plan.searches) - len(queries)} duplicate search(es)"
+        )
+    results = await asyncio.gather(
+        *(run_search(q) for q in queries),
+        return_exceptions=True,
+    )
+    notes_parts: List[str] = []
+    for q, r in zip(queries, results):
+        if isinstance(r, BaseException):
+            notes_parts.append(f"[{q}] (search failed: {r})")
+            continue
+        sources = "\n".join(f"- {s}" for s in r.sources)
+        notes_parts.append(f"[{q}]\n{r.summary}\nSources:\n{sources}")
+    research_notes = "\n\n".join(notes_parts)
+    await yield_status(f"Searches complete ({len(queries)} run)")
+
+    # 4) Write + 5) Convert, overlapped: the writer's streamed JSON deltas are
+    # scanned for the markdown_report field and converted to HTML while tokens
+    # are still arriving, so conversion CPU hides inside writer latency.
+    writer_prompt = (
+        f"Original query: {query}\n"
+        f"{clar_text}\n\n"
+        f"Research notes:\n{research_notes}\n\n"
+        "Write a 1000+ word Markdown report with sections: Executive Summary, "
+        "Key Findings (with [#] citations), Assumptions & Limitations, "
+        "Open Questions, and Next Steps."
+    )
+    conv = _StreamingMarkdownConverter()
+    field = _JsonStringFieldStream("markdown_report")
+    published = 0
+    async with _LLM_SEM:  # streamed call counts against the concurrency cap
+        stream = Runner.run_streamed(writer_agent, writer_prompt)
+        async for event in stream.stream_events():
+            if event.type == "raw_response_event":
+                delta = getattr(event.data, "delta", None)
+                if isinstance(delta, str) and delta:
+                    piece = field.feed(delta)
+                    if piece:
+                        conv.feed(piece)
+                        # Push a partial-report frame once enough new content has
+                        # accumulated; the UI fills in while the writer streams.
+                        body = conv.snapshot()
+                        if len(body) - published >= 512:
+                            published = len(body)
+                            await REPORT_BUS.publish(_wrap_html(body, "Research Report"))
+    report = stream.final_output_as(ReportData)
+    await yield_status("Report written")
+
+    if field.found:
+        html_doc = _wrap_html(conv.close(), "Research Report")
+    else:
+        # Field never appeared in the raw stream; convert the final output.
+        html_doc = (await convert_to_html_async(report.markdown_report, "Research Report"))["html"]
+
+    # 6) Email (optional)
+    recipient = (email or "").strip()
+    if recipient and recipient != "(none)":
+        outcome = await send_email_impl(recipient, f"Research Report: {query[:80]}", html_doc)
+        if outcome.get("status") == "sent":
+            await yield_status("Email sent")
+        else:
+            await yield_status(f"Email not sent: {outcome.get('reason', 'unknown')}")
+
+    return html_doc
 
 # --------------------------------------------------------------------------------------
 # UI Helpers for Clarifications
@@ -287,24 +665,30 @@ manager_agent = Agent(
 def _format_user_clarifications(clar):
     if clar.get("skipped"):
         return "USER_CLARIFICATIONS: (skipped by user)"
-    lines = ["USER_CLARIFICATIONS:"]
-    for i, (q, a) in enumerate(itertools.zip_longest(clar.get("questions", []), clar.get("answers", []), fillvalue="")):
+    parts = ["USER_CLARIFICATIONS:"]
+    pairs = itertools.zip_longest(clar.get("questions", []), clar.get("answers", []), fillvalue="")
+    for i, (q, a) in enumerate(pairs, 1):
         q = (q or "").strip()
         a = (a or "").strip()
-        if q or a:
-            lines.append(f"Q{i+1}: {q}" + (f"\nA{i+1}: {a}" if a else ""))
-    return "\n".join(lines) if len(lines) > 1 else "USER_CLARIFICATIONS: (none provided)"
+        if q:
+            parts.append(f"Q{i}: {q}")
+        if a:
+            parts.append(f"A{i}: {a}")
+    return "\n".join(parts) if len(parts) > 1 else "USER_CLARIFICATIONS: (none provided)"
 
 async def gen_clarifications(query: str):
+    _enable_eager_tasks()
     if not (query or "").strip():
         return gr.update(value=""), gr.update(value=""), gr.update(value=""), "Enter a query first."
-    res = await Runner.run(clarifier_agent, query.strip())
-    qs = res.final_output
+    # One LLM call produces questions AND the search plan; the plan is cached,
+    # so pressing Run later skips the planner round-trip entirely.
+    prep = await run_prep(query.strip())
+    qs = prep.questions
     msg = "Generated 3 clarifying questions. You may edit them or add answers, or tick 'Skip' to proceed without."
     return qs.q1, qs.q2, qs.q3, msg
 
 # --------------------------------------------------------------------------------------
-# Manager-backed streaming run that yields (status, report HTML) frames
+# Streaming run that yields (status, report HTML) frames
 # --------------------------------------------------------------------------------------
 async def run_with_clarifications(query: str,
                                   email: str,
@@ -312,6 +696,7 @@ async def run_with_clarifications(query: str,
                                   q2: str, a2: str,
                                   q3: str, a3: str,
                                   skip: bool):
+    _enable_eager_tasks()
     clar = {
         "skipped": bool(skip),
         "questions": [q1, q2, q3],
@@ -327,58 +712,54 @@ async def run_with_clarifications(query: str,
         trace_url = f"https://platform.openai.com/traces/trace?trace_id={trace_id}"
         await STATUS_BUS.publish(f"Trace ready: {trace_url}\n")
 
-        mgr_input = (
-            f"QUERY: {query}\n"
-            f"{clar_text or 'USER_CLARIFICATIONS: (none provided)'}\n"
-            f"RECIPIENT_EMAIL: {(email or '').strip() or '(none)'}\n" 
-            "Follow the pipeline and use the tools only. Stream progress via yield_status."
+        pipeline_task = asyncio.create_task(
+            run_pipeline(query, clar_text or "USER_CLARIFICATIONS: (none provided)", email)
         )
 
-        async def _run_mgr():
-            res = await Runner.run(
-                manager_agent,
-                mgr_input,
-                max_turns=25,
+        # Live-drain STATUS_BUS while the pipeline runs. Event-driven: wake on
+        # whichever finishes first (a new message or the pipeline) instead of
+        # polling on a timeout, so messages reach the UI as soon as published.
+        get_task = asyncio.create_task(STATUS_BUS.get_wait())
+        report_task = asyncio.create_task(REPORT_BUS.get_wait())
+        while not pipeline_task.done():
+            done, _ = await asyncio.wait(
+                {get_task, report_task, pipeline_task},
+                return_when=asyncio.FIRST_COMPLETED,
             )
-            final = getattr(res, "final_output", None) or getattr(res, "output", None)
-            return str(final) if final else "Finished (no output)"
-
-        mgr_task = asyncio.create_task(_run_mgr())
-
-        # Live-drain STATUS_BUS while the manager runs
-        while not mgr_task.done():
-            msg = await STATUS_BUS.get(timeout=0.3)
-            if msg:
-                status_md.append(f"• {msg}")
-                # yield status + whatever report_html we have so far (initially empty)
+            changed = False
+            if get_task in done:
+                # Batch: fold in everything already queued so a burst of
+                # messages costs one UI frame instead of one per message.
+                batch = [get_task.result(), *STATUS_BUS.drain_nowait()]
+                status_md.extend(f"• {m}" for m in batch)
+                changed = True
+                get_task = asyncio.create_task(STATUS_BUS.get_wait())
+            if report_task in done:
+                # Only the newest partial-report snapshot matters.
+                frames = [report_task.result(), *REPORT_BUS.drain_nowait()]
+                report_html = frames[-1]
+                changed = True
+                report_task = asyncio.create_task(REPORT_BUS.get_wait())
+            if changed:
                 yield "\n".join(status_md), report_html
-
-        # Manager now returns **HTML** by contract
+        # Harvest readers that completed while the generator was suspended at
+        # a yield — cancelling them would drop already-dequeued messages.
+        if get_task.done():
+            status_md.append(f"• {get_task.result()}")
+        else:
+            get_task.cancel()
+        if report_task.done():
+            report_task.result()  # superseded by the final pipeline HTML below
+        else:
+            report_task.cancel()
+
+        # Pipeline returns the final report as HTML
         try:
-            report_html = await mgr_task  # HTML string
-        except InputGuardrailTripwireTriggered as e:
-            info = getattr(e.result, "output_info", {}) if hasattr(e, "result") else {}
-            flags = set(info.get("flags", []) or [])
-            reason = info.get("brief", "The request did not meet safety or clarity requirements.")
-            hard_flags = {"unsafe", "illegal", "pii", "adult", "private_data"}
-            if flags & hard_flags:
-                status_md.append(f"⚠️ Input blocked by guardrails.\nReason: {reason}\nFlags: {', '.join(sorted(flags))}")
-                yield "\n".join(status_md), report_html
-                return
-            # Soft case: surface 3 clarifying questions
-            clar = await Runner.run(clarifier_agent, query)
-            qs = clar.final_output
-            status_md.append("🔎 Clarifying questions:")
-            status_md.append(f"1) {qs.q1}")
-            status_md.append(f"2) {qs.q2}")
-            status_md.append(f"3) {qs.q3}")
-            yield "\n".join(status_md), report_html
-            return
-        except OutputGuardrailTripwireTriggered as e:
-            info = getattr(e.result, "output_info", {}) if hasattr(e, "result") else {}
-            flags = ", ".join(info.get("flags", [])) or "unspecified"
-            reason = info.get("brief", "The draft did not pass quality checks.")
-            status_md.append(f"⚠️ Output blocked by guardrails.\nReason: {reason}\nFlags: {flags}")
+            report_html = await pipeline_task  # HTML string
+        except GuardrailBlocked as e:
+            status_md.append(
+                f"⚠️ Input blocked by guardrails.\nReason: {e.brief}\nFlags: {', '.join(sorted(e.flags))}"
+            )
             yield "\n".join(status_md), report_html
             return
         except Exception as e:
@@ -386,14 +767,12 @@ async def run_with_clarifications(query: str,
             yield "\n".join(status_md), report_html
             return
 
-        # Flush any stragglers
-        for _ in range(5):
-            msg = await STATUS_BUS.get(timeout=0.05)
-            if not msg:
-                break
-            status_md.append(f"• {msg}")
+        # Flush any stragglers; partial-report frames are superseded by the
+        # final HTML returned from the pipeline.
+        status_md.extend(f"• {msg}" for msg in STATUS_BUS.drain_nowait())
+        REPORT_BUS.drain_nowait()
 
-        # Final yield: status + HTML from manager
+        # Final yield: status + report HTML
         yield "\n".join(status_md), report_html
 
 # --------------------------------------------------------------------------------------
@@ -455,6 +834,9 @@ with gr.Blocks(theme=gr.themes.Default(primary_hue="sky")) as ui:
         outputs=[status_panel, report]
     )
 
+    # Warm API connections as soon as a session opens, before any query.
+    ui.load(fn=_prewarm_connections)
+
 # Queue so generator yields stream to UI
 ui.queue()
 